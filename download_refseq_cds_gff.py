@@ -8,13 +8,50 @@ It focuses on chromosome-level assemblies for better quality data.
 
 import os
 import sys
+import errno
 import subprocess
 import zipfile
 import shutil
 import argparse
 from pathlib import Path
-import json
 import logging
+import json
+import io
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+import hashlib
+import time
+import random
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Optional: ISA-L accelerated DEFLATE (pip install isal) for faster zip extraction
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
+
+class _IsalZipFile(zipfile.ZipFile):
+    """ZipFile whose DEFLATE members are inflated by ISA-L, leaving zipfile itself untouched."""
+    
+    def open(self, name, mode="r", pwd=None, **kwargs):
+        ext_file = super().open(name, mode, pwd, **kwargs)
+        # Swap the decompressor before anything is read (raw DEFLATE, like zipfile's own).
+        # These are private ZipExtFile attributes (checked on CPython 3.8-3.13); if a release
+        # renames them, the entry is simply inflated with stock zlib
+        if (mode == "r" and getattr(ext_file, "_compress_type", None) == zipfile.ZIP_DEFLATED
+                and hasattr(ext_file, "_decompressor")):
+            ext_file._decompressor = isal_zlib.decompressobj(-15)
+        return ext_file
+
+
+# Only this script's reads use ISA-L; other zipfile users in the process keep stock zlib
+ZIP_READER = _IsalZipFile if isal_zlib is not None else zipfile.ZipFile
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -23,54 +60,199 @@ logger = logging.getLogger(__name__)
 # Path to NCBI datasets tool
 DATASETS_TOOL = "/home5/ibirchl/Bioinformatics_tools/datasets"
 
+# NCBI Datasets v2 REST API used for in-memory downloads
+DATASETS_API_URL = "https://api.ncbi.nlm.nih.gov/datasets/v2"
+API_TIMEOUT = 60  # seconds without progress before a request is abandoned
+API_PAGE_SIZE = 1000  # maximum page size for dataset reports
+
+# Default number of taxa processed concurrently
+DEFAULT_JOBS = 4
+
+# Default limit on how many NCBI requests (datasets invocations + API calls) this script
+# starts per second across all taxa; NCBI allows 3 requests per second without an API key
+DEFAULT_REQUESTS_PER_SECOND = 3
+
+# Longest batch label used as-is in output filenames; longer batches are labelled by a hash
+MAX_LABEL_LENGTH = 64
+
+# datasets rehydrate --max-workers: default total across all concurrently rehydrating
+# taxa, and the range the datasets tool accepts
+DEFAULT_REHYDRATE_WORKERS = 10
+MAX_REHYDRATE_WORKERS = 30
+
+# Chunk size for streaming zip entries to disk; large chunks keep the number of
+# write syscalls per output file low
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Classifies data file paths: RefSeq CDS (cds_from_genomic.fna) or GFF annotation (*.gff / *.gff3)
+DATA_FILE_PATTERN = re.compile(r"(?P<cds>(?:^|/)cds_from_genomic\.fna$)|(?P<gff>\.gff3?$)")
+
+# Pulls record_count out of datasets --preview JSON without parsing the whole document
+RECORD_COUNT_PATTERN = re.compile(rb'"record_count"\s*:\s*(\d+)')
+
+# Retry policy for transient NCBI errors (rate limiting, dropped connections, 5xx)
+MAX_ATTEMPTS = 5
+MAX_BACKOFF = 60
+# Status codes are anchored so accessions, byte counts etc. containing "429"/"503" don't match
+TRANSIENT_ERROR = re.compile(rb"\b(?:429|50[234])\b|too many requests|goaway|timed? ?out|temporarily",
+                             re.IGNORECASE)
+
+# How long cached --preview results stay valid (seconds); only non-empty results are cached
+PREVIEW_CACHE_TTL = 24 * 60 * 60
+
 class RefSeqDataDownloader:
-    def __init__(self, output_dir="refseq_data", datasets_tool=DATASETS_TOOL):
+    def __init__(self, output_dir="refseq_data", datasets_tool=DATASETS_TOOL, jobs=DEFAULT_JOBS,
+                 dehydrated=False, in_memory=False, skip_preview=False, force=False,
+                 requests_per_second=DEFAULT_REQUESTS_PER_SECOND,
+                 rehydrate_workers=DEFAULT_REHYDRATE_WORKERS):
         self.output_dir = Path(output_dir)
         self.datasets_tool = datasets_tool
+        self.jobs = max(1, jobs)
+        self.dehydrated = dehydrated
+        self.rehydrate_workers = rehydrate_workers
+        # Number of taxa processed at the same time; set per run by download_family_data
+        self._concurrent_taxa = 1
+        self.in_memory = in_memory
+        self.skip_preview = skip_preview
+        self.force = force
+        # Space out request starts to respect NCBI's rate limit; requests may overlap, so a
+        # long download never holds up the other --jobs workers
+        self.request_interval = 1.0 / requests_per_second if requests_per_second > 0 else 0.0
+        self._next_request_at = time.monotonic()
+        self._request_lock = threading.Lock()
         self.cds_dir = self.output_dir / "cds_files"
         self.gff_dir = self.output_dir / "gff_files"
+        self.preview_cache_dir = self.output_dir / ".preview_cache"
+        self.completed_dir = self.output_dir / ".completed"
         
         # Create output directories
         self.output_dir.mkdir(exist_ok=True)
         self.cds_dir.mkdir(exist_ok=True)
         self.gff_dir.mkdir(exist_ok=True)
     
+    def _wait_for_request_slot(self):
+        """Block until this thread may start an NCBI request under the requests-per-second limit."""
+        with self._request_lock:
+            now = time.monotonic()
+            start = max(now, self._next_request_at)
+            self._next_request_at = start + self.request_interval
+        if start > now:
+            time.sleep(start - now)
+    
+    def _retry(self, operation, is_transient, max_attempts=MAX_ATTEMPTS):
+        """Call operation(), retrying transient failures with jittered exponential backoff."""
+        for attempt in range(1, max_attempts + 1):
+            try:
+                return operation()
+            except Exception as e:
+                if attempt == max_attempts or not is_transient(e):
+                    raise
+                if isinstance(e, subprocess.CalledProcessError):
+                    detail = e.stderr.decode(errors='replace').strip()
+                else:
+                    detail = str(e)
+                delay = min(MAX_BACKOFF, random.uniform(0.5, 1.5) * 2 ** (attempt - 1))
+                logger.warning(f"Transient NCBI error (attempt {attempt}/{max_attempts}), "
+                               f"retrying in {delay:.1f}s: {detail}")
+                time.sleep(delay)
+    
+    @staticmethod
+    def _is_transient_datasets_error(error):
+        """Whether a failed datasets invocation looks like rate limiting or a network hiccup."""
+        return (isinstance(error, subprocess.CalledProcessError)
+                and TRANSIENT_ERROR.search(error.stderr or b"") is not None)
+    
+    @staticmethod
+    def _is_transient_http_error(error):
+        """Whether a failed API request was rate limited, a 5xx, or a dropped/stalled connection."""
+        if isinstance(error, urllib.error.HTTPError):
+            return error.code == 429 or 500 <= error.code < 600
+        return isinstance(error, (urllib.error.URLError, TimeoutError, ConnectionError,
+                                  http.client.HTTPException))
+    
+    def _run_datasets(self, args, max_attempts=MAX_ATTEMPTS):
+        """Run the datasets tool with the given arguments, under the NCBI request rate limit.
+        
+        Transient NCBI errors are retried with jittered exponential backoff.
+        Output is captured as bytes; callers decode only what they need.
+        """
+        def run():
+            self._wait_for_request_slot()
+            return subprocess.run([self.datasets_tool, *args], capture_output=True, check=True)
+        
+        return self._retry(run, self._is_transient_datasets_error, max_attempts)
+    
+    def _run_preview(self, args):
+        """Run a datasets --preview query, reusing a cached result younger than PREVIEW_CACHE_TTL.
+        
+        With force the cache is bypassed (and refreshed). Results without any records are
+        never cached, so a family that gains assemblies is picked up on the next run.
+        """
+        key = hashlib.sha1(repr(args).encode()).hexdigest()
+        cache_file = self.preview_cache_dir / f"{key}.json"
+        
+        if not self.force:
+            try:
+                if time.time() - cache_file.stat().st_mtime < PREVIEW_CACHE_TTL:
+                    logger.debug(f"Using cached preview: {cache_file}")
+                    return cache_file.read_bytes()
+            except FileNotFoundError:
+                pass
+        
+        output = self._run_datasets(args).stdout
+        
+        match = RECORD_COUNT_PATTERN.search(output)
+        if not match or int(match.group(1)) == 0:
+            cache_file.unlink(missing_ok=True)
+            return output
+        
+        # Write to a temporary name first so concurrent readers never see a partial file
+        self.preview_cache_dir.mkdir(exist_ok=True)
+        temp_file = cache_file.with_name(f"{cache_file.name}.{uuid.uuid4().hex}.tmp")
+        temp_file.write_bytes(output)
+        os.replace(temp_file, cache_file)
+        
+        return output
+    
     def check_datasets_tool(self):
         """Check if the datasets tool is available and working."""
         try:
-            result = subprocess.run([self.datasets_tool, "--version"], 
-                                  capture_output=True, text=True, check=True)
-            logger.info(f"NCBI datasets tool version: {result.stdout.strip()}")
+            result = self._run_datasets(["--version"])
+            logger.info(f"NCBI datasets tool version: {result.stdout.decode().strip()}")
             return True
         except (subprocess.CalledProcessError, FileNotFoundError) as e:
             logger.error(f"Error accessing datasets tool: {e}")
             return False
     
     def get_available_species(self, family):
-        """Get list of available species for a family from RefSeq with chromosome-level assemblies."""
+        """Get list of available species for a family (or batch of taxa) from RefSeq with chromosome-level assemblies."""
+        taxa = [family] if isinstance(family, str) else list(family)
+        family = self._taxon_label(family)
+        
+        if self.skip_preview:
+            # The download itself reports whether there is anything to fetch
+            logger.info(f"Skipping availability check for {family}")
+            return taxa
+        
         logger.info(f"Searching for available {family} species with chromosome-level assemblies...")
         
         try:
             # Search for the family with chromosome-level assemblies
-            cmd = [
-                self.datasets_tool, "download", "genome", "taxon", family,
+            args = [
+                "download", "genome", "taxon", *taxa,
                 "--include", "cds,gff3",
                 "--assembly-level", "chromosome",
                 "--preview"
             ]
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+            output = self._run_preview(args)
             
-            # Parse the JSON output to get record count
-            if "record_count" in result.stdout:
-                data = json.loads(result.stdout)
-                record_count = data.get("record_count", 0)
+            # Get the record count from the JSON output
+            match = RECORD_COUNT_PATTERN.search(output)
+            record_count = int(match.group(1)) if match else 0
+            
+            if record_count > 0:
                 logger.info(f"Found {record_count} {family} genomes with chromosome-level assemblies and CDS/GFF annotations")
-                
-                if record_count > 0:
-                    return [family]
-                else:
-                    logger.warning(f"No {family} genomes with chromosome-level assemblies found")
-                    return []
+                return taxa
             else:
                 logger.warning(f"No {family} genomes with chromosome-level assemblies found")
                 return []
@@ -79,8 +261,26 @@ class RefSeqDataDownloader:
             logger.error(f"Error searching for {family} species: {e}")
             return []
     
+    @staticmethod
+    def _taxon_label(taxon):
+        """Name used in logs and output filenames for a taxon or a batch of taxa.
+        
+        A batch is labelled by its sorted taxa joined with "-", or "batch-<hash>" once that
+        would exceed MAX_LABEL_LENGTH, so the label is independent of argument order and
+        always fits in a filename.
+        """
+        if isinstance(taxon, str):
+            return taxon
+        taxa = sorted(set(taxon))
+        label = "-".join(taxa)
+        if len(label) > MAX_LABEL_LENGTH:
+            label = "batch-" + hashlib.sha1(",".join(taxa).encode()).hexdigest()[:12]
+        return label
+    
     def download_genome_data(self, family, include_cds=True, include_gff=True):
-        """Download genome data for a specific family with chromosome-level assemblies."""
+        """Download genome data for a family (or a batch of taxa) with chromosome-level assemblies."""
+        taxa = [family] if isinstance(family, str) else list(family)
+        family = self._taxon_label(family)
         logger.info(f"Downloading genome data for {family} (chromosome-level assemblies only)...")
         
         # Build the include parameter
@@ -95,26 +295,32 @@ class RefSeqDataDownloader:
         
         include_param = ",".join(include_files)
         
-        # Create a unique filename for this download
-        filename = f"refseq_{family}_chromosome_data.zip"
+        # Create a unique filename for this download (safe for concurrent/retried runs)
+        filename = f"refseq_{family}_chromosome_data_{uuid.uuid4().hex}.zip"
         
         try:
-            cmd = [
-                self.datasets_tool, "download", "genome", "taxon", family,
+            # Several taxa can be fetched in a single request
+            args = [
+                "download", "genome", "taxon", *taxa,
                 "--include", include_param,
                 "--assembly-level", "chromosome",
                 "--filename", filename
             ]
+            if self.dehydrated:
+                # Fetch only the manifest; the data files are pulled in parallel by rehydrate
+                args.append("--dehydrated")
             
-            logger.info(f"Running command: {' '.join(cmd)}")
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+            logger.info(f"Running command: {self.datasets_tool} {' '.join(args)}")
+            self._run_datasets(args)
             logger.info(f"Download completed for {family}")
             
             return filename
             
         except subprocess.CalledProcessError as e:
             logger.error(f"Error downloading data for {family}: {e}")
-            logger.error(f"stderr: {e.stderr}")
+            logger.error(f"stderr: {e.stderr.decode(errors='replace')}")
+            # Don't leave a partially written zip behind
+            Path(filename).unlink(missing_ok=True)
             return None
     
     def extract_and_organize_files(self, zip_filename, family):
@@ -125,91 +331,433 @@ class RefSeqDataDownloader:
             logger.error(f"Zip file {zip_filename} not found")
             return False
         
+        try:
+            total_files = self._extract_members(zip_filename, family)
+            return total_files > 0
+            
+        except Exception as e:
+            logger.error(f"Error extracting files: {e}")
+            return False
+        finally:
+            # Remove the zip whether or not extraction worked; each attempt downloads under a
+            # new name, so a kept zip (several GB for large families) is never reused
+            Path(zip_filename).unlink(missing_ok=True)
+    
+    def _api_request(self, path, query=None, body=None):
+        """Send a request to the NCBI Datasets REST API and return the response body.
+        
+        A JSON body turns the request into a POST. Transient failures (429, 5xx, dropped or
+        stalled connections) are retried with the same backoff as datasets invocations.
+        Raises OSError (URLError/HTTPError) or http.client.HTTPException on failure.
+        """
+        url = DATASETS_API_URL + path
+        if query:
+            url += "?" + urllib.parse.urlencode(query)
+        
+        data = None
+        headers = {}
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        
+        request = urllib.request.Request(url, data=data, headers=headers)
+        
+        def fetch():
+            self._wait_for_request_slot()
+            logger.debug(f"Requesting: {url}")
+            with urllib.request.urlopen(request, timeout=API_TIMEOUT) as response:
+                return response.read()
+        
+        return self._retry(fetch, self._is_transient_http_error)
+    
+    def _get_chromosome_accessions(self, taxa):
+        """Look up the accessions of chromosome-level assemblies for the given taxa."""
+        path = "/genome/taxon/" + urllib.parse.quote(",".join(taxa), safe=",") + "/dataset_report"
+        query = [
+            ("filters.assembly_level", "chromosome"),
+            ("returned_content", "ASSM_ACC"),
+            ("page_size", API_PAGE_SIZE)
+        ]
+        
+        accessions = []
+        page_token = None
+        while True:
+            page_query = (query + [("page_token", page_token)]) if page_token else query
+            page = json.loads(self._api_request(path, page_query))
+            accessions.extend(report["accession"] for report in page.get("reports", []))
+            page_token = page.get("next_page_token")
+            if not page_token:
+                return accessions
+    
+    def download_and_extract_in_memory(self, family, include_cds=True, include_gff=True):
+        """Download the genome package into memory and extract CDS and GFF files in one pass."""
+        taxa = [family] if isinstance(family, str) else list(family)
+        family = self._taxon_label(family)
+        logger.info(f"Downloading genome data for {family} into memory (chromosome-level assemblies only)...")
+        
+        # Build the annotation types to include
+        annotation_types = []
+        if include_cds:
+            annotation_types.append("CDS_FASTA")
+        if include_gff:
+            annotation_types.append("GENOME_GFF")
+        
+        if not annotation_types:
+            annotation_types = ["CDS_FASTA", "GENOME_GFF"]  # Default to both
+        
+        try:
+            # The v2 API only downloads by accession, so resolve the chromosome-level
+            # assemblies first (this is where the assembly-level filter is applied)
+            accessions = self._get_chromosome_accessions(taxa)
+            if not accessions:
+                logger.warning(f"No {family} genomes with chromosome-level assemblies found")
+                return False
+            logger.info(f"Found {len(accessions)} {family} chromosome-level assemblies")
+            
+            # POST keeps long accession lists out of the URL
+            data = self._api_request("/genome/download", body={
+                "accessions": accessions,
+                "include_annotation_type": annotation_types
+            })
+            logger.info(f"Download completed for {family} ({len(data)} bytes)")
+        except (OSError, http.client.HTTPException, ValueError, KeyError) as e:
+            logger.error(f"Error downloading data for {family}: {e}")
+            return False
+        
+        try:
+            return self._extract_members(data, family) > 0
+        except Exception as e:
+            logger.error(f"Error extracting files: {e}")
+            return False
+    
+    @staticmethod
+    def _open_zip(zip_source):
+        """Open a zip from a file path or from an in-memory bytes payload."""
+        if isinstance(zip_source, bytes):
+            # BytesIO shares the bytes buffer, so every handle avoids a copy
+            return ZIP_READER(io.BytesIO(zip_source), 'r')
+        return ZIP_READER(zip_source, 'r')
+    
+    def _extract_members(self, zip_source, family):
+        """Stream the CDS and GFF entries of a zip to their destination. Returns the file count."""
+        cds_count = 0
+        gff_count = 0
+        targets = []
+        logger.debug(f"Inflating {family} with {'ISA-L' if isal_zlib is not None else 'zlib'}")
+        with self._open_zip(zip_source) as zip_ref:
+            entries = [info for info in zip_ref.infolist() if not info.is_dir()]
+        
+        # Pick out the CDS and GFF entries and where each one should go
+        for info in entries:
+            match = DATA_FILE_PATTERN.search(info.filename)
+            if not match:
+                continue
+            
+            species_name = Path(info.filename).parent.name
+            
+            # CDS files (RefSeq format)
+            if match.group("cds"):
+                targets.append((info, "CDS", self.cds_dir / f"{species_name}_{family}.fna"))
+                cds_count += 1
+            # GFF files (RefSeq format)
+            else:
+                targets.append((info, "GFF", self.gff_dir / f"{species_name}_{family}.gff"))
+                gff_count += 1
+        
+        # Decompress entries concurrently (zlib releases the GIL while inflating)
+        if targets:
+            # ZipFile objects aren't safe to share between threads, so each worker opens
+            # its own handle once and reuses it for every entry it extracts
+            worker = threading.local()
+            handles = []
+            
+            def extract(target):
+                zip_ref = getattr(worker, "zip_ref", None)
+                if zip_ref is None:
+                    zip_ref = worker.zip_ref = self._open_zip(zip_source)
+                    handles.append(zip_ref)
+                self._extract_one(zip_ref, *target)
+            
+            try:
+                with ThreadPoolExecutor(max_workers=min(len(targets), os.cpu_count() or 1)) as executor:
+                    list(executor.map(extract, targets))
+            finally:
+                for zip_ref in handles:
+                    zip_ref.close()
+        
+        logger.info(f"Extracted {cds_count} CDS / {gff_count} GFF files for {family}")
+        
+        # Check if we found any files
+        total_files = cds_count + gff_count
+        if total_files == 0:
+            self._report_missing_files(family, [info.filename for info in entries])
+        
+        return total_files
+    
+    def rehydrate_and_organize_files(self, zip_filename, family):
+        """Rehydrate a dehydrated download and organize the fetched CDS and GFF files."""
+        logger.info(f"Rehydrating and organizing files from {zip_filename}...")
+        
+        if not os.path.exists(zip_filename):
+            logger.error(f"Zip file {zip_filename} not found")
+            return False
+        
+        # Unique temporary directory so concurrent/retried runs don't collide
+        temp_dir = Path(f"temp_{family}_{uuid.uuid4().hex}")
+        
         try:
             with zipfile.ZipFile(zip_filename, 'r') as zip_ref:
-                # Extract all files
-                zip_ref.extractall(f"temp_{family}")
-            
-            # Find and move CDS and GFF files
-            temp_dir = Path(f"temp_{family}")
-            
-            # Look for CDS files (RefSeq format)
-            cds_files = list(temp_dir.rglob("cds_from_genomic.fna"))
-            for cds_file in cds_files:
-                species_name = cds_file.parent.name
-                new_name = f"{species_name}_{family}.fna"
-                shutil.move(str(cds_file), str(self.cds_dir / new_name))
-                logger.info(f"Moved CDS file: {new_name}")
-            
-            # Look for GFF files (RefSeq format)
-            gff_files = list(temp_dir.rglob("*.gff"))
-            for gff_file in gff_files:
-                species_name = gff_file.parent.name
-                new_name = f"{species_name}_{family}.gff"
-                shutil.move(str(gff_file), str(self.gff_dir / new_name))
-                logger.info(f"Moved GFF file: {new_name}")
+                # Extract the manifest (small: no sequence or annotation data yet)
+                zip_ref.extractall(temp_dir)
             
-            # Check if we found any files
-            total_files = len(cds_files) + len(gff_files)
-            if total_files == 0:
-                logger.warning(f"No CDS or GFF files found for {family}. This may indicate:")
-                logger.warning("  - The genome assemblies don't have gene annotations")
-                logger.warning("  - Annotations are in a different format")
-                logger.warning("  - Only raw genome sequences are available")
-                
-                # List what files are actually available
-                all_files = list(temp_dir.rglob("*"))
-                logger.info(f"Available files in {family} dataset:")
-                for file_path in all_files:
-                    if file_path.is_file():
-                        logger.info(f"  - {file_path.relative_to(temp_dir)}")
+            # Fetch the data files listed in the manifest with parallel workers, splitting the
+            # worker budget across taxa rehydrating at the same time
+            workers = self.rehydrate_workers // self._concurrent_taxa
+            workers = max(1, min(MAX_REHYDRATE_WORKERS, workers))
+            args = [
+                "rehydrate",
+                "--directory", str(temp_dir),
+                "--max-workers", str(workers)
+            ]
+            logger.info(f"Running command: {self.datasets_tool} {' '.join(args)}")
+            self._run_datasets(args)
+            
+            # Classify and move CDS and GFF files in a single walk of the tree
+            cds_count = 0
+            gff_count = 0
+            other_files = []
+            # Only collect unmatched files when they'll be listed (at DEBUG)
+            list_other_files = logger.isEnabledFor(logging.DEBUG)
+            for root, _, files in os.walk(temp_dir):
+                species_name = os.path.basename(root)
+                for name in files:
+                    match = DATA_FILE_PATTERN.search(name)
+                    if not match:
+                        if list_other_files:
+                            other_files.append(os.path.relpath(os.path.join(root, name), temp_dir))
+                    # CDS files (RefSeq format)
+                    elif match.group("cds"):
+                        new_name = f"{species_name}_{family}.fna"
+                        self._move_file(os.path.join(root, name), self.cds_dir / new_name)
+                        logger.debug(f"Moved CDS file: {new_name}")
+                        cds_count += 1
+                    # GFF files (RefSeq format)
+                    else:
+                        new_name = f"{species_name}_{family}.gff"
+                        self._move_file(os.path.join(root, name), self.gff_dir / new_name)
+                        logger.debug(f"Moved GFF file: {new_name}")
+                        gff_count += 1
             
-            # Clean up temporary directory
-            shutil.rmtree(temp_dir)
+            logger.info(f"Moved {cds_count} CDS / {gff_count} GFF files for {family}")
             
-            # Remove the zip file
-            os.remove(zip_filename)
+            # Check if we found any files
+            total_files = cds_count + gff_count
+            if total_files == 0:
+                self._report_missing_files(family, other_files)
             
             return total_files > 0
             
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Error rehydrating data for {family}: {e}")
+            logger.error(f"stderr: {e.stderr.decode(errors='replace')}")
+            return False
         except Exception as e:
-            logger.error(f"Error extracting files: {e}")
+            logger.error(f"Error organizing files: {e}")
             return False
+        finally:
+            # Clean up the temporary directory (can be large once rehydrated) and the
+            # dehydrated zip, whether or not rehydration worked
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            Path(zip_filename).unlink(missing_ok=True)
+    
+    @staticmethod
+    def _move_file(src, dst):
+        """Move a file with a single rename, copying only when crossing filesystems."""
+        try:
+            os.replace(src, dst)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        
+        # Cross-filesystem: shutil.copyfile already copies in-kernel (sendfile) on Linux.
+        # Copy to a temporary name beside dst and remove src only once dst is complete.
+        dst = Path(dst)
+        partial = dst.with_name(f".{dst.name}.{uuid.uuid4().hex}.part")
+        try:
+            shutil.copyfile(src, partial)
+            shutil.copystat(src, partial)
+            os.replace(partial, dst)
+        except BaseException:
+            partial.unlink(missing_ok=True)
+            raise
+        os.remove(src)
+    
+    def _report_missing_files(self, family, available_files):
+        """Explain why no CDS or GFF files were found and list what the dataset contained."""
+        logger.warning(f"No CDS or GFF files found for {family}. This may indicate:")
+        logger.warning("  - The genome assemblies don't have gene annotations")
+        logger.warning("  - Annotations are in a different format")
+        logger.warning("  - Only raw genome sequences are available")
+        
+        # List what files are actually available (can be long, so only with --verbose)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Available files in {family} dataset:")
+            for name in available_files:
+                logger.debug(f"  - {name}")
+        else:
+            logger.info(f"Run with --verbose to list the files in the {family} dataset")
+    
+    def _extract_one(self, zip_ref, info, kind, target):
+        """Stream a single zip entry to its destination using the calling worker's zip handle."""
+        # Write to a temporary name in the same directory and rename only once the entry has
+        # been fully decompressed and CRC-checked, so a failure never leaves a partial output
+        partial = target.with_name(f".{target.name}.{uuid.uuid4().hex}.part")
+        try:
+            with zip_ref.open(info) as src, open(partial, "wb", buffering=COPY_CHUNK_SIZE) as dst:
+                # Reserve the full size up front for fewer extents / less fragmentation
+                if info.file_size and hasattr(os, "posix_fallocate"):
+                    try:
+                        os.posix_fallocate(dst.fileno(), 0, info.file_size)
+                    except OSError:
+                        pass  # Not supported by this filesystem
+                shutil.copyfileobj(src, dst, length=COPY_CHUNK_SIZE)
+            os.replace(partial, target)
+        except BaseException:
+            partial.unlink(missing_ok=True)
+            raise
+        logger.debug(f"Extracted {kind} file: {target.name}")
     
-    def download_family_data(self, family, include_cds=True, include_gff=True):
-        """Download data for a specific family with chromosome-level assemblies."""
-        available_species = self.get_available_species(family)
+    def _process_taxon(self, taxon, include_cds=True, include_gff=True):
+        """Download and extract data for a taxon (or batch of taxa). Returns True on success."""
+        label = self._taxon_label(taxon)
+        logger.info(f"Processing {label}...")
+        
+        if self.in_memory:
+            if self.download_and_extract_in_memory(taxon, include_cds, include_gff):
+                self._mark_done(taxon, label, include_cds, include_gff)
+                logger.info(f"Successfully processed {label}")
+                return True
+            logger.error(f"Failed to download and extract data for {label}")
+            return False
+        
+        # Download the data
+        zip_filename = self.download_genome_data(taxon, include_cds, include_gff)
         
-        if not available_species:
-            logger.error(f"No {family} species with chromosome-level assemblies found")
+        if not zip_filename:
+            logger.error(f"Failed to download data for {label}")
             return False
         
-        logger.info(f"Found {len(available_species)} {family} taxa with chromosome-level assemblies")
+        # Extract (or rehydrate) and organize the files
+        if self.dehydrated:
+            organized = self.rehydrate_and_organize_files(zip_filename, label)
+        else:
+            organized = self.extract_and_organize_files(zip_filename, label)
+        
+        if organized:
+            self._mark_done(taxon, label, include_cds, include_gff)
+            logger.info(f"Successfully processed {label}")
+            return True
+        
+        logger.error(f"Failed to extract files for {label}")
+        return False
+    
+    def _mark_done(self, taxon, label, include_cds=True, include_gff=True):
+        """Record that every requested output for a taxon (or batch) was written successfully."""
+        taxa = [taxon] if isinstance(taxon, str) else sorted(set(taxon))
+        marker = self.completed_dir / f"{label}.json"
+        
+        # Write to a temporary name first so an interrupted write never looks complete
+        self.completed_dir.mkdir(exist_ok=True)
+        temp_file = marker.with_name(f"{marker.name}.{uuid.uuid4().hex}.tmp")
+        temp_file.write_text(json.dumps({"families": taxa, "cds": include_cds, "gff": include_gff}))
+        os.replace(temp_file, marker)
+    
+    def _already_done(self, family, include_cds=True, include_gff=True):
+        """Check whether a previous run fully completed the requested outputs for a family.
+        
+        Completion markers are only written after a taxon (or a batch containing it) was
+        processed successfully, so outputs left by a failed run are never mistaken for done.
+        """
+        for marker in self.completed_dir.glob("*.json"):
+            try:
+                done = json.loads(marker.read_text())
+            except (OSError, ValueError):
+                continue
+            if (family in done.get("families", [])
+                    and (done.get("cds") or not include_cds)
+                    and (done.get("gff") or not include_gff)):
+                return True
+        return False
+    
+    def download_family_data(self, family, include_cds=True, include_gff=True, batch=False):
+        """Download data for one or more families with chromosome-level assemblies.
+        
+        With batch=True all available families are fetched with a single datasets request
+        and their output files share one label for the families actually downloaded (see
+        _taxon_label); completion markers list those families, so resume doesn't rely on it.
+        With skip_preview nothing is probed, so a successful batch marks every family in it.
+        """
+        families = [family] if isinstance(family, str) else list(family)
         
-        success_count = 0
-        for taxon in available_species:
-            logger.info(f"Processing {taxon}...")
+        # Skip families completed by a previous run (batched or not)
+        if not self.force:
+            done = [f for f in families if self._already_done(f, include_cds, include_gff)]
             
-            # Download the data
-            zip_filename = self.download_genome_data(taxon, include_cds, include_gff)
+            for f in done:
+                logger.info(f"Skipping {f}: already completed by a previous run (use --force to re-download)")
             
-            if zip_filename:
-                # Extract and organize the files
-                if self.extract_and_organize_files(zip_filename, taxon):
-                    success_count += 1
-                    logger.info(f"Successfully processed {taxon}")
-                else:
-                    logger.error(f"Failed to extract files for {taxon}")
+            families = [f for f in families if f not in done]
+            if not families:
+                return True
+        
+        family = self._taxon_label(families)
+        
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            # Probe each family separately (even when batching) so a batch only contains, and
+            # its completion marker only records, families that have assemblies to download
+            available_species = [
+                taxon
+                for species in executor.map(self.get_available_species, families)
+                for taxon in species
+            ]
+            
+            if not available_species:
+                logger.error(f"No {family} species with chromosome-level assemblies found")
+                return False
+            
+            logger.info(f"Found {len(available_species)} {family} taxa with chromosome-level assemblies")
+            
+            if batch and len(available_species) > 1:
+                batch_taxa = tuple(available_species)
+                logger.info(f"Batch outputs are labelled {self._taxon_label(batch_taxa)} "
+                            f"({', '.join(sorted(set(batch_taxa)))})")
+                tasks = [batch_taxa]
             else:
-                logger.error(f"Failed to download data for {taxon}")
+                tasks = available_species
+            self._concurrent_taxa = min(self.jobs, len(tasks))
+            
+            # Download and extract taxa concurrently (work is network and zip I/O bound)
+            success_count = 0
+            futures = {
+                executor.submit(self._process_taxon, taxon, include_cds, include_gff): taxon
+                for taxon in tasks
+            }
+            for future in as_completed(futures):
+                taxon = futures[future]
+                try:
+                    if future.result():
+                        success_count += 1
+                except Exception as e:
+                    logger.error(f"Unexpected error processing {self._taxon_label(taxon)}: {e}")
         
-        logger.info(f"Successfully processed {success_count}/{len(available_species)} taxa")
+        logger.info(f"Successfully processed {success_count}/{len(tasks)} taxa")
         return success_count > 0
 
 def main():
     parser = argparse.ArgumentParser(description="Download RefSeq CDS and GFF files for any family using NCBI datasets")
-    parser.add_argument("--family", required=True,
-                       help="Family name to download (e.g., gobiidae, apogonidae, salmonidae)")
+    parser.add_argument("--family", required=True, nargs="+",
+                       help="Family name(s) to download (e.g., gobiidae, apogonidae, salmonidae)")
     parser.add_argument("--output-dir", default="refseq_data", 
                        help="Output directory for downloaded files (default: refseq_data)")
     parser.add_argument("--no-cds", action="store_true", 
@@ -218,11 +766,52 @@ def main():
                        help="Skip downloading GFF files")
     parser.add_argument("--datasets-tool", default=DATASETS_TOOL,
                        help=f"Path to NCBI datasets tool (default: {DATASETS_TOOL})")
+    parser.add_argument("--jobs", type=int, default=DEFAULT_JOBS,
+                       help=f"Number of taxa to download/extract concurrently (default: {DEFAULT_JOBS})")
+    parser.add_argument("--requests-per-second", type=float, default=DEFAULT_REQUESTS_PER_SECOND,
+                       help="Maximum number of NCBI requests (datasets invocations and API calls) "
+                            "started per second across all taxa; requests made inside one datasets "
+                            "process, e.g. by rehydrate workers, are not counted, and 0 disables "
+                            f"the limit (default: {DEFAULT_REQUESTS_PER_SECOND})")
+    parser.add_argument("--dehydrated", action="store_true",
+                       help="Download a dehydrated package and fetch files with 'datasets rehydrate' "
+                            "(recommended for large families)")
+    parser.add_argument("--rehydrate-workers", type=int, default=DEFAULT_REHYDRATE_WORKERS,
+                       help="Total 'datasets rehydrate' download workers, shared by taxa rehydrating "
+                            f"at the same time; each taxon gets 1-{MAX_REHYDRATE_WORKERS} "
+                            f"(default: {DEFAULT_REHYDRATE_WORKERS})")
+    parser.add_argument("--in-memory", action="store_true",
+                       help="Download each package into memory from the NCBI Datasets API and extract "
+                            "CDS/GFF files without writing the zip to disk (for small to moderate families)")
+    parser.add_argument("--skip-preview", action="store_true",
+                       help="Skip the availability check and go straight to the download "
+                            "(non-empty preview results are otherwise cached for 24 hours); with "
+                            "--batch, every family in a successful batch is then recorded as completed")
+    parser.add_argument("--force", action="store_true",
+                       help="Re-download families even if a previous run completed them (as "
+                            "recorded in <output-dir>/.completed/), and refresh cached preview "
+                            "results instead of reusing them")
+    parser.add_argument("--verbose", action="store_true",
+                       help="Log every extracted file and list dataset contents when nothing matches")
+    parser.add_argument("--batch", action="store_true",
+                       help="Fetch all families with a single datasets request; output files are "
+                            "labelled with the sorted names of the families downloaded (e.g. "
+                            "GCF_..._apogonidae-gobiidae.fna; skipped or unavailable families are left out), "
+                            f"or batch-<hash> when that is longer than {MAX_LABEL_LENGTH} characters")
     
     args = parser.parse_args()
     
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+    
+    if args.dehydrated and args.in_memory:
+        logger.error("--dehydrated and --in-memory cannot be used together")
+        sys.exit(1)
+    
     # Initialize downloader
-    downloader = RefSeqDataDownloader(args.output_dir, args.datasets_tool)
+    downloader = RefSeqDataDownloader(args.output_dir, args.datasets_tool, args.jobs,
+                                      args.dehydrated, args.in_memory, args.skip_preview, args.force,
+                                      args.requests_per_second, args.rehydrate_workers)
     
     # Check if datasets tool is available
     if not downloader.check_datasets_tool():
@@ -238,8 +827,8 @@ def main():
         sys.exit(1)
     
     # Download data
-    logger.info(f"Downloading data for family: {args.family}")
-    success = downloader.download_family_data(args.family, include_cds, include_gff)
+    logger.info(f"Downloading data for family: {', '.join(args.family)}")
+    success = downloader.download_family_data(args.family, include_cds, include_gff, args.batch)
     
     if success:
         logger.info("Download process completed successfully!")